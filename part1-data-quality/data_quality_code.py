@@ -1,21 +1,35 @@
+import functools
 import os
 import glob
-import json
 import re
-from urllib.parse import urlparse, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote_plus
 
+import orjson
+import xxhash
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
 
 
 # ============================================================
 # CONFIG
 # ============================================================
 
-DATA_GLOB = "data/events_2025*.csv"    
+DATA_GLOB = "data/events_2025*.csv"
 OUT_DIR = "part1-data-quality"
 os.makedirs(OUT_DIR, exist_ok=True)
 
+# Canonical (normalized) columns the DQ checks operate on
+required_normalized = ["clientid", "pageurl", "referrer", "timestamp", "eventname", "eventdata", "useragent"]
+
+_NORM_RE = re.compile(r"[^a-z0-9]")
+
+@functools.lru_cache(maxsize=None)
+def normalize_name(c):
+    return _NORM_RE.sub("", c.lower())
+
 
 # ============================================================
 # LOAD DATA
@@ -25,30 +39,46 @@ paths = sorted(glob.glob(DATA_GLOB))
 if not paths:
     raise FileNotFoundError("No event files found.")
 
-dfs = []
-file_column_map = {}
-
-for p in paths:
-    df = pd.read_csv(p, dtype=str)
-    df.columns = [c.strip().lower() for c in df.columns]
-    df["source_file"] = os.path.basename(p)
-
-    # Save the columns seen in this file (used later for per-file schema checks)
-    cols = [c.strip().lower() for c in df.columns]
-    file_column_map[os.path.basename(p)] = cols
-    dfs.append(df)
-
-events = pd.concat(dfs, ignore_index=True)
-events.columns = [c.strip().lower() for c in events.columns]
+def load_file(p):
+    # Header-only read to learn the columns, then force everything to string
+    # so the threaded Arrow parser never guesses types. Columns the DQ
+    # checks never look at are dropped at parse time rather than carried
+    # through the whole run.
+    header_cols = pacsv.open_csv(p).schema.names
+    keep_cols = [c for c in header_cols if normalize_name(c) in required_normalized]
+    tbl = pacsv.read_csv(
+        p,
+        read_options=pacsv.ReadOptions(block_size=64 << 20),
+        convert_options=pacsv.ConvertOptions(
+            column_types={c: pa.string() for c in header_cols},
+            include_columns=keep_cols,
+            strings_can_be_null=True,  # match pandas NA semantics for empty fields
+        ),
+    )
+    cols = [c.strip().lower() for c in tbl.column_names]
+    tbl = tbl.rename_columns(cols)
+    tbl = tbl.append_column(
+        "source_file", pa.array([os.path.basename(p)] * tbl.num_rows, type=pa.string())
+    )
+    return tbl, cols
+
+# The Arrow CSV parser releases the GIL, so threads overlap disk I/O with
+# parsing across files. ex.map keeps results in path order, so the
+# concatenated frame is identical to the old serial loop.
+with ThreadPoolExecutor(max_workers=min(8, len(paths))) as ex:
+    loaded = list(ex.map(load_file, paths))
+
+tables = [tbl for tbl, _ in loaded]
+# Columns seen per file (used later for per-file schema checks)
+file_column_map = {os.path.basename(p): cols for p, (_, cols) in zip(paths, loaded)}
+
+events = pa.concat_tables(tables, promote_options="permissive").to_pandas()
 
 
 # ============================================================
 # NORMALIZE COLUMNS → CANONICAL SCHEMA
 # ============================================================
 
-def normalize_name(c):
-    return re.sub(r"[^a-z0-9]", "", c.lower())
-
 col_map = {normalize_name(c): c for c in events.columns}
 
 expected = {
@@ -77,8 +107,10 @@ for canon, existing in canon_map.items():
 # PARSE TIMESTAMP
 # ============================================================
 
+# Pin the ISO-8601 fast path — the mixed-format inference fallback is far
+# slower and can silently vary with the first rows it sees.
 events["timestamp_parsed"] = pd.to_datetime(
-    events["timestamp"], utc=True, errors="coerce"
+    events["timestamp"], format="ISO8601", utc=True, errors="coerce"
 )
 
 
@@ -86,46 +118,58 @@ events["timestamp_parsed"] = pd.to_datetime(
 # PARSE event_data JSON SAFELY
 # ============================================================
 
-def safe_json(s):
-    if pd.isna(s) or s is None:
-        return None
-    s = str(s).strip()
-    if s == "":
-        return None
+# Sentinel marking rows that failed strict parsing (retried with repair below)
+_JSON_FAIL = object()
+
+def bulk_parse_json(values):
+    out = np.empty(len(values), dtype=object)
+    loads = orjson.loads
+
+    # Pass 1: strict parse with orjson's C decoder
+    for i, s in enumerate(values):
+        if s is None or s != s:
+            continue
+        try:
+            out[i] = loads(s)
+        except Exception:
+            out[i] = _JSON_FAIL
 
-    # Try strict JSON
-    try:
-        return json.loads(s)
-    except:
-        pass
+    # Pass 2: repair only the failing subset (single quotes → double quotes)
+    for i in np.flatnonzero(out == _JSON_FAIL):
+        try:
+            out[i] = loads(str(values[i]).replace("'", '"'))
+        except Exception:
+            out[i] = None
 
-    # Try repair: convert single quotes → double quotes
-    try:
-        return json.loads(s.replace("'", '"'))
-    except:
-        return None
+    return out
 
-events["event_data_parsed"] = events["event_data"].apply(safe_json)
+# Event payloads repeat heavily, so parse each distinct string once and
+# fan the results back out with the inverse index.
+_ed_uniq, _ed_inv = np.unique(events["event_data"].fillna("").to_numpy(), return_inverse=True)
+events["event_data_parsed"] = bulk_parse_json(_ed_uniq)[_ed_inv]
 
 
 # ============================================================
 # EXTRACT UTM PARAMETERS
 # ============================================================
 
-def extract_utms(url):
-    try:
-        qs = parse_qs(urlparse(str(url)).query)
-        return (
-            qs.get("utm_source", [None])[0],
-            qs.get("utm_medium", [None])[0],
-            qs.get("utm_campaign", [None])[0],
-        )
-    except:
-        return None, None, None
+UTM_RE = re.compile(r"[?&]utm_(source|medium|campaign)=([^&#]*)")
 
-events[["utm_source", "utm_medium", "utm_campaign"]] = (
-    events["page_url"].fillna("").apply(lambda u: pd.Series(extract_utms(u)))
-)
+def extract_utms(url):
+    # Single regex scan instead of full urlparse + parse_qs decomposition.
+    # Keep the first non-empty value per key, like parse_qs did.
+    found = {}
+    for key, val in UTM_RE.findall(str(url)):
+        if val and key not in found:
+            found[key] = unquote_plus(val)
+    return found.get("source"), found.get("medium"), found.get("campaign")
+
+# URLs repeat too — extract UTMs once per distinct URL
+_url_uniq, _url_inv = np.unique(events["page_url"].fillna("").to_numpy(), return_inverse=True)
+_utm_uniq = np.array([extract_utms(u) for u in _url_uniq], dtype=object)
+events["utm_source"] = _utm_uniq[_url_inv, 0]
+events["utm_medium"] = _utm_uniq[_url_inv, 1]
+events["utm_campaign"] = _utm_uniq[_url_inv, 2]
 
 
 # ============================================================
@@ -137,9 +181,6 @@ checks = []
 # ------------------------------------------------------------
 # 0. STRICT PER-FILE SCHEMA VALIDATION
 # ------------------------------------------------------------
-required_normalized = ["clientid", "pageurl", "referrer", "timestamp", "eventname", "eventdata", "useragent"]
-
-
 # Per-file missing columns (using normalized names)
 file_norm_map = {fname: set(normalize_name(c) for c in cols)
                  for fname, cols in file_column_map.items()}
@@ -184,7 +225,13 @@ checks.append({
 })
 
 # 1. Row Counts
-rows_per_file = events.groupby("source_file").size().reset_index(name="rows")
+events["source_file"] = events["source_file"].astype("category")
+rows_per_file = (
+    events["source_file"]
+    .value_counts(sort=False)
+    .rename_axis("source_file")
+    .reset_index(name="rows")
+)
 
 mean_rows = rows_per_file["rows"].mean()
 zero_row_files = rows_per_file[rows_per_file["rows"] == 0]
@@ -241,8 +288,21 @@ events["json_error"] = events["event_data"].notna() & events["event_data_parsed"
 checks.append({"check": "json_parse", "status": "fail" if events['json_error'].sum() else "pass"})
 
 # 6. Duplicate Events
+# Hash the subset columns into one 64-bit key per row so the duplicate
+# check runs on a single integer column (nulls kept distinct from "").
 dup_cols = ["source_file", "timestamp", "event_name", "event_data"]
-dup_count = events.duplicated(subset=dup_cols).sum()
+_dup_keys = np.fromiter(
+    (
+        xxhash.xxh64_intdigest(
+            "\x1f".join(v if isinstance(v, str) else "\x00" for v in row).encode("utf-8")
+        )
+        for row in zip(*(events[c] for c in dup_cols))
+    ),
+    dtype=np.uint64,
+    count=len(events),
+)
+dup_mask = pd.Series(_dup_keys).duplicated().to_numpy()
+dup_count = dup_mask.sum()
 checks.append({"check": "duplicates", "status": "fail" if dup_count else "pass",
                "details": dup_count})
 
@@ -252,15 +312,17 @@ checks.append({"check": "client_id_nulls", "status": "warn" if null_client_ids e
                "details": null_client_ids})
 
 # 8. Referrer Anonymization Heuristic
-def is_anonymized(dom):
-    if dom is None:
-        return False
-    return len(dom) > 30 or bool(re.search(r"[0-9a-f]{12,}", dom))
+# One vectorized regex pass pulls the authority part (what urlparse calls
+# netloc) straight out of the referrer URL.
+events["referrer_domain"] = (
+    events["referrer"].str.extract(r"^[a-zA-Z][a-zA-Z0-9+.-]*://([^/?#]+)", expand=False).str.lower()
+)
 
-events["referrer_domain"] = events["referrer"].apply(
-    lambda r: urlparse(str(r)).netloc.lower() if isinstance(r, str) else None
+# Both heuristics map straight onto vectorized string kernels
+_dom = events["referrer_domain"]
+events["referrer_anonymized"] = (_dom.str.len() > 30) | _dom.str.contains(
+    r"[0-9a-f]{12,}", regex=True, na=False
 )
-events["referrer_anonymized"] = events["referrer_domain"].apply(is_anonymized)
 
 anon_rate = events["referrer_anonymized"].mean()
 
@@ -317,14 +379,15 @@ checks.append({"check": "purchase_price_validation",
 # WRITE DETECTED ISSUE SAMPLE
 # ============================================================
 
-issues = events[
-    (events["json_error"]) |
-    (events.duplicated(subset=dup_cols)) |
-    (events["event_name"].isin(invalid_event_names)) |
-    (events["client_id"].isna())
-]
+# Pull each predicate out as a plain ndarray and OR them bitwise; this
+# skips the Index alignment pandas does for every Series `|`.
+m_json = events["json_error"].to_numpy()
+m_bad = events["event_name"].isin(invalid_event_names).to_numpy()
+m_cid = events["client_id"].isna().to_numpy()
+issue_mask = m_json | dup_mask | m_bad | m_cid
 
-issues.head(200).to_csv(f"{OUT_DIR}/detected_issues_sample.csv", index=False)
+issues = events.iloc[np.flatnonzero(issue_mask)[:200]]
+issues.to_csv(f"{OUT_DIR}/detected_issues_sample.csv", index=False)
 
 
 # ============================================================
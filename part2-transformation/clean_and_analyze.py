@@ -1,20 +1,26 @@
 # clean_and_analyze.py
+import csv
+import functools
+import hashlib
 import os
 import glob
-import json
 import re
-from urllib.parse import urlparse, parse_qs
+from urllib.parse import unquote_plus
 from datetime import timezone
 import duckdb
+import orjson
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import xxhash
 
 # -----------------------
 # Config - edit if needed
 # -----------------------
 DATA_GLOB = "data/events_2025*.csv"   # same pattern as your validation code
-OUT_DIR = r"part2-transformation\output"
+OUT_DIR = os.path.join("part2-transformation", "output")
 CLEANED_PARQUET = os.path.join(OUT_DIR, "cleaned_events.parquet")
+MANIFEST_PATH = os.path.join(OUT_DIR, "manifest.json")
 os.makedirs(OUT_DIR, exist_ok=True)
 
 # Conservative remap for purchase-like taxonomy issues:
@@ -31,8 +37,28 @@ SESSION_GAP_SECONDS = 1800  # 30 minutes
 # -----------------------
 # Helpers
 # -----------------------
+def hash_rows(df, cols):
+    """64-bit xxhash over the given string columns, one key per row.
+
+    Collapses a multi-column duplicate check into a single integer key
+    (nulls are kept distinct from empty strings via a marker byte).
+    """
+    return np.fromiter(
+        (
+            xxhash.xxh64_intdigest(
+                "\x1f".join(v if isinstance(v, str) else "\x00" for v in row).encode("utf-8")
+            )
+            for row in zip(*(df[c] for c in cols))
+        ),
+        dtype=np.uint64,
+        count=len(df),
+    )
+
+_NORM_RE = re.compile(r"[^a-z0-9]")
+
+@functools.lru_cache(maxsize=None)
 def normalize_name(c):
-    return re.sub(r"[^a-z0-9]", "", c.strip().lower()) if c is not None else ""
+    return _NORM_RE.sub("", c.strip().lower()) if c is not None else ""
 
 def safe_json_parse(s):
     if s is None:
@@ -41,27 +67,91 @@ def safe_json_parse(s):
     if s == "":
         return None
     try:
-        return json.loads(s)
+        return orjson.loads(s)
     except Exception:
         # try single-quote repair
         try:
-            return json.loads(s.replace("'", '"'))
+            return orjson.loads(s.replace("'", '"'))
         except Exception:
             return None
 
+UTM_RE = re.compile(r"[?&]utm_(source|medium|campaign)=([^&#]*)")
+
 def extract_utms_from_url(url):
-    try:
-        qs = parse_qs(urlparse(str(url)).query)
-        return qs.get("utm_source", [None])[0], qs.get("utm_medium", [None])[0], qs.get("utm_campaign", [None])[0]
-    except Exception:
-        return None, None, None
+    # Single regex scan instead of full urlparse + parse_qs decomposition.
+    # Keep the first non-empty value per key, like parse_qs did.
+    found = {}
+    for key, val in UTM_RE.findall(str(url)):
+        if val and key not in found:
+            found[key] = unquote_plus(val)
+    return found.get("source"), found.get("medium"), found.get("campaign")
+
+# One combined alternation instead of ~18 LIKE '%...%' scans per row in SQL.
+# Longest tokens first so e.g. 'windows nt' wins over 'windows'.
+UA_TOKEN_RE = re.compile(
+    r"(windows nt|mac os x|macintosh|windows|edgios|crios|fxios|iphone|ipad"
+    r"|android|mobile|firefox|chrome|safari|linux|x11|edg)"
+)
 
-def extract_domain(url):
-    try:
-        domain = urlparse(str(url)).netloc.lower()
-        return domain if domain != "" else None
-    except Exception:
-        return None
+def classify_user_agent(ua):
+    """Return (device_type, os, browser) from a lowercased UA token scan.
+
+    Mirrors the CASE chains previously in the analytics_events_with_device
+    view, including their precedence.
+    """
+    if not ua:
+        return ("unknown", "Other", "Other")
+    tokens = set(UA_TOKEN_RE.findall(ua))
+    # longer alternatives consume their substrings, so restore the implied ones
+    if "windows nt" in tokens:
+        tokens.add("windows")
+    if "edgios" in tokens:
+        tokens.add("edg")
+
+    if "ipad" in tokens:
+        device = "tablet"
+    elif "iphone" in tokens or ("android" in tokens and "mobile" in tokens):
+        device = "mobile"
+    elif "android" in tokens:
+        device = "tablet"
+    elif "mobile" in tokens:
+        device = "mobile"
+    elif "windows" in tokens or "macintosh" in tokens or "x11" in tokens:
+        device = "desktop"
+    else:
+        device = "unknown"
+
+    if "iphone" in tokens or "ipad" in tokens:
+        os_name = "iOS"
+    elif "android" in tokens:
+        os_name = "Android"
+    elif "windows nt" in tokens:
+        os_name = "Windows"
+    elif "mac os x" in tokens and "iphone" not in tokens:
+        os_name = "MacOS"
+    elif "linux" in tokens:
+        os_name = "Linux"
+    else:
+        os_name = "Other"
+
+    if "crios" in tokens:
+        browser = "Chrome (iOS)"
+    elif "fxios" in tokens:
+        browser = "Firefox (iOS)"
+    elif "edgios" in tokens:
+        browser = "Edge (iOS)"
+    elif "chrome" in tokens and "edg" not in tokens:
+        browser = "Chrome"
+    elif "safari" in tokens and "chrome" not in tokens:
+        browser = "Safari"
+    elif "firefox" in tokens:
+        browser = "Firefox"
+    elif "edg" in tokens:
+        browser = "Edge"
+    else:
+        browser = "Other"
+
+    return device, os_name, browser
 
 def extract_price(event_data_parsed):
     if isinstance(event_data_parsed, dict):
@@ -107,134 +197,194 @@ def extract_from_items(ed, key):
 
 
 # -----------------------
-# Step 1: Load & combine CSVs
+# Step 1: Input fingerprint / cache check
 # -----------------------
 paths = sorted(glob.glob(DATA_GLOB))
 if not paths:
     raise FileNotFoundError(f"No files found for glob: {DATA_GLOB}")
 
-dfs = []
-file_column_map = {}
-for p in paths:
-    df = pd.read_csv(p, dtype=str)
-    # normalize column names (lowercase)
-    df.columns = [c.strip().lower() for c in df.columns]
-    df["source_file"] = os.path.basename(p)
-    cols = [c.strip().lower() for c in df.columns]
-    file_column_map[os.path.basename(p)] = cols
-    dfs.append(df)
-
-events = pd.concat(dfs, ignore_index=True)
-events.columns = [c.strip().lower() for c in events.columns]
-
-# Canonical mapping (same as your validation)
-expected = {
-    "clientid": "client_id",
-    "pageurl": "page_url",
-    "referrer": "referrer",
-    "timestamp": "timestamp",
-    "eventname": "event_name",
-    "eventdata": "event_data",
-    "useragent": "user_agent",
-}
-col_map = {normalize_name(c): c for c in events.columns}
-canon_map = {v: col_map.get(k) for k, v in expected.items()}
-
-for canon, orig in canon_map.items():
-    if orig is None:
-        events[canon] = None
-    else:
-        events[canon] = events[orig]
-
-# Ensure referrer column exists (may be missing in some files)
-if "referrer" not in events.columns:
-    events["referrer"] = None
-
-# -----------------------
-# Step 2: Clean transforms in pandas
-# -----------------------
-
-# 2.1 Fix known taxonomy issues (conservative remap)
-events["event_name"] = events["event_name"].fillna("").astype(str).str.strip()
-events["event_name"] = events["event_name"].apply(lambda v: EVENT_NAME_REMAP.get(v, v) if v != "" else None)
-
-# 2.2 Add flags for missing referrer at file-level and row-level
-# files missing referrer:
-files_missing_referrer = {f for f, cols in file_column_map.items() if "referrer" not in cols}
-events["source_file_referrer_missing"] = events["source_file"].apply(lambda f: f in files_missing_referrer)
-events["referrer_missing"] = events["referrer"].isna()
-
-# 2.3 Drop exact duplicates (keep first)
-# use only columns that exist in df from DUP_SUBSET
-dup_subset_existing = [c for c in DUP_SUBSET if c in events.columns]
-before_count = len(events)
-events = events.drop_duplicates(subset=dup_subset_existing, keep="first")
-after_count = len(events)
-dropped_dupes = before_count - after_count
-
-# 2.4 Parse timestamp to pandas datetime (UTC)
-events["timestamp_utc"] = pd.to_datetime(events["timestamp"], utc=True, errors="coerce")
-
-# 2.5 Parse event_data JSON and extract price/total/quantity/product_id
-events["event_data_parsed"] = events["event_data"].apply(safe_json_parse)
-events["price"] = events["event_data_parsed"].apply(extract_price)
-# extract total & quantity if present
-def get_key(ed, key):
-    if isinstance(ed, dict) and key in ed:
-        return ed[key]
-    return None
-
-
-events["quantity"] = events["event_data_parsed"].apply(
-    lambda ed: get_key(ed, "quantity") or extract_from_items(ed, "quantity")
-)
-
-events["product_id"] = events["event_data_parsed"].apply(
-    lambda ed:
-        get_key(ed, "product_id")
-        or get_key(ed, "item_id")
-        or get_key(ed, "sku")
-        or extract_from_items(ed, "product_id")
-        or extract_from_items(ed, "sku")
-        or extract_from_items(ed, "item_id")
-)
-
-# derive total safely
-events["unit_price"] = events["event_data_parsed"].apply(
-    lambda ed: extract_price(ed) or extract_from_items(ed, "price")
-)
-
-events["total"] = (
-    pd.to_numeric(events["unit_price"], errors="coerce") *
-    pd.to_numeric(events["quantity"], errors="coerce")
-)
-
+# Fingerprint the inputs; if nothing changed since the last successful run
+# we can skip the whole parse/clean stage and reuse the cached parquet.
+input_fp = hashlib.sha1(
+    orjson.dumps(sorted((p, os.path.getmtime(p), os.path.getsize(p)) for p in paths))
+).hexdigest()
 
-# 2.6 Extract UTMs and referrer domain
-events[["utm_source", "utm_medium", "utm_campaign"]] = events["page_url"].fillna("").apply(lambda u: pd.Series(extract_utms_from_url(u)))
-events["referrer_domain"] = events["referrer"].apply(extract_domain)
-
-# 2.7 Mark missing client_id (we do not drop by default)
-events["client_id_missing"] = events["client_id"].isna()
+con = duckdb.connect(database=':memory:')
 
-# 2.8 Final normalization: cast types
-# price numeric
-events["price"] = pd.to_numeric(events["price"], errors="coerce")
-events["total"] = pd.to_numeric(events["total"], errors="coerce")
-events["quantity"] = pd.to_numeric(events["quantity"], errors="coerce")
+cache_hit = False
+if os.path.exists(CLEANED_PARQUET) and os.path.exists(MANIFEST_PATH):
+    try:
+        with open(MANIFEST_PATH, "rb") as fh:
+            cache_hit = orjson.loads(fh.read()).get("fp") == input_fp
+    except Exception:
+        cache_hit = False
+
+if cache_hit:
+    print(f"Inputs unchanged; reusing cached {CLEANED_PARQUET}")
+    con.execute(f"CREATE TABLE events AS SELECT * FROM read_parquet('{CLEANED_PARQUET}');")
+    dropped_dupes = "skipped (cache hit)"
+else:
+    # Per-file header map (drives the referrer-missing flags below)
+    file_column_map = {}
+    for p in paths:
+        with open(p, newline="", encoding="utf-8") as fh:
+            header = next(csv.reader(fh))
+        file_column_map[os.path.basename(p)] = [c.strip().lower() for c in header]
+
+    # read_csv runs multithreaded in C++ and unions the files in one pass;
+    # all_varchar matches the old pd.read_csv(dtype=str) behaviour.
+    events = con.execute(f"""
+    SELECT * FROM read_csv('{DATA_GLOB}', all_varchar=true, union_by_name=true, filename=true)
+    """).fetchdf()
+    events["source_file"] = events.pop("filename").map(os.path.basename)
+    events.columns = [c.strip().lower() for c in events.columns]
+
+    # Canonical mapping (same as your validation). union_by_name keeps header
+    # variants (e.g. clientId vs client_id) as separate columns, exactly like
+    # the old lowercase-then-concat path did, so the mapping below is unchanged.
+    expected = {
+        "clientid": "client_id",
+        "pageurl": "page_url",
+        "referrer": "referrer",
+        "timestamp": "timestamp",
+        "eventname": "event_name",
+        "eventdata": "event_data",
+        "useragent": "user_agent",
+    }
+    col_map = {normalize_name(c): c for c in events.columns}
+    canon_map = {v: col_map.get(k) for k, v in expected.items()}
+
+    for canon, orig in canon_map.items():
+        if orig is None:
+            events[canon] = None
+        else:
+            events[canon] = events[orig]
+
+    # Ensure referrer column exists (may be missing in some files)
+    if "referrer" not in events.columns:
+        events["referrer"] = None
+
+    # -----------------------
+    # Step 2: Clean transforms in pandas
+    # -----------------------
+
+    # 2.1 Fix known taxonomy issues (conservative remap)
+    events["event_name"] = events["event_name"].fillna("").astype(str).str.strip()
+    events["event_name"] = events["event_name"].apply(lambda v: EVENT_NAME_REMAP.get(v, v) if v != "" else None)
+
+    # 2.2 Add flags for missing referrer at file-level and row-level
+    # files missing referrer:
+    files_missing_referrer = {f for f, cols in file_column_map.items() if "referrer" not in cols}
+    events["source_file_referrer_missing"] = events["source_file"].apply(lambda f: f in files_missing_referrer)
+    events["referrer_missing"] = events["referrer"].isna()
+
+    # 2.3 Drop exact duplicates (keep first)
+    # use only columns that exist in df from DUP_SUBSET; a single xxhash key
+    # per row replaces the multi-column string hashing inside drop_duplicates
+    dup_subset_existing = [c for c in DUP_SUBSET if c in events.columns]
+    before_count = len(events)
+    events["_dkey"] = hash_rows(events, dup_subset_existing)
+    events = events.drop_duplicates("_dkey", keep="first").drop(columns="_dkey")
+    after_count = len(events)
+    dropped_dupes = before_count - after_count
+
+    # 2.4 Parse timestamp to pandas datetime (UTC)
+    events["timestamp_utc"] = pd.to_datetime(events["timestamp"], format="ISO8601", utc=True, errors="coerce")
+
+    # 2.5 Parse event_data JSON and extract price/total/quantity/product_id.
+    # Payload strings repeat heavily, so parse + extract once per unique value
+    # and fan out with the inverse index; the four fields come from a single
+    # walk of each dict instead of four separate .apply passes.
+    def get_key(ed, key):
+        if isinstance(ed, dict) and key in ed:
+            return ed[key]
+        return None
 
-# Save cleaned dataset to parquet
-#events.to_csv(os.path.join(OUT_DIR, "cleaned_events.csv"), index=False)
-events.to_parquet(CLEANED_PARQUET, index=False)
-print(f"Saved cleaned parquet to: {CLEANED_PARQUET}")
-#print(f"Dropped duplicates: {dropped_dupes}")
-
-# -----------------------
-# Step 3: DuckDB - register table and run SQL transforms/views
-# -----------------------
-con = duckdb.connect(database=':memory:')
-# register parquet as a view/table
-con.execute(f"CREATE TABLE events AS SELECT * FROM read_parquet('{CLEANED_PARQUET}');")
+    def extract_payload_fields(ed):
+        price = extract_price(ed)
+        quantity = get_key(ed, "quantity") or extract_from_items(ed, "quantity")
+        product_id = (
+            get_key(ed, "product_id")
+            or get_key(ed, "item_id")
+            or get_key(ed, "sku")
+            or extract_from_items(ed, "product_id")
+            or extract_from_items(ed, "sku")
+            or extract_from_items(ed, "item_id")
+        )
+        unit_price = price or extract_from_items(ed, "price")
+        return price, quantity, product_id, unit_price
+
+    _ed_uniq, _ed_inv = np.unique(events["event_data"].fillna("").to_numpy(), return_inverse=True)
+    _parsed_uniq = np.array([safe_json_parse(s) for s in _ed_uniq], dtype=object)
+    _fields_uniq = np.array([extract_payload_fields(ed) for ed in _parsed_uniq], dtype=object)
+
+    events["event_data_parsed"] = _parsed_uniq[_ed_inv]
+    events["price"] = _fields_uniq[_ed_inv, 0]
+    events["quantity"] = _fields_uniq[_ed_inv, 1]
+    events["product_id"] = _fields_uniq[_ed_inv, 2]
+    events["unit_price"] = _fields_uniq[_ed_inv, 3]
+
+    events["total"] = (
+        pd.to_numeric(events["unit_price"], errors="coerce") *
+        pd.to_numeric(events["quantity"], errors="coerce")
+    )
+
+
+    # 2.6 Extract UTMs and referrer domain
+    events[["utm_source", "utm_medium", "utm_campaign"]] = events["page_url"].fillna("").apply(lambda u: pd.Series(extract_utms_from_url(u)))
+    events["referrer_domain"] = (
+        events["referrer"].str.extract(r"^[a-zA-Z][a-zA-Z0-9+.-]*://([^/?#]+)", expand=False).str.lower()
+    )
+
+    # 2.7 Classify device/os/browser once per unique user agent
+    _ua_uniq, _ua_inv = np.unique(events["user_agent"].fillna("").str.lower().to_numpy(), return_inverse=True)
+    _ua_class = np.array([classify_user_agent(u) for u in _ua_uniq], dtype=object)
+    events["device_type"] = _ua_class[_ua_inv, 0]
+    events["os"] = _ua_class[_ua_inv, 1]
+    events["browser"] = _ua_class[_ua_inv, 2]
+
+    # 2.8 Mark missing client_id (we do not drop by default)
+    events["client_id_missing"] = events["client_id"].isna()
+
+    # 2.9 Final normalization: cast types and downcast for a compact parquet
+    # price/total fit comfortably in float32; quantity is a small integer
+    events["price"] = pd.to_numeric(events["price"], errors="coerce").astype("float32")
+    events["total"] = pd.to_numeric(events["total"], errors="coerce").astype("float32")
+    events["quantity"] = pd.to_numeric(events["quantity"], errors="coerce", downcast="integer")
+
+    # Low-cardinality strings → category (dictionary-encoded in parquet)
+    LOW_CARD_COLS = [
+        "event_name", "source_file", "utm_source", "utm_medium", "utm_campaign",
+        "referrer_domain", "device_type", "os", "browser",
+    ]
+    for c in LOW_CARD_COLS:
+        events[c] = events[c].astype("category")
+
+    # Save cleaned dataset to parquet.
+    # Pre-sorting on (client_id, timestamp_utc) means every window/session
+    # query downstream reads per-client rows contiguously instead of
+    # re-shuffling; mergesort is stable so equal-timestamp rows keep file order.
+    events = events.sort_values(["client_id", "timestamp_utc"], kind="mergesort")
+    #events.to_csv(os.path.join(OUT_DIR, "cleaned_events.csv"), index=False)
+    events.to_parquet(CLEANED_PARQUET, index=False, compression="zstd",
+                      compression_level=3, use_dictionary=True,
+                      row_group_size=256_000)
+    print(f"Saved cleaned parquet to: {CLEANED_PARQUET}")
+    #print(f"Dropped duplicates: {dropped_dupes}")
+
+    # -----------------------
+    # Step 3: DuckDB - register table and run SQL transforms/views
+    # (reuses the connection opened for CSV loading in Step 1)
+    # -----------------------
+    # Hand the cleaned frame to DuckDB as an Arrow table (zero-copy) instead of
+    # re-reading the parquet we just wrote; the parquet stays as the durable
+    # output for part3/part4.
+    arrow_events = pa.Table.from_pandas(events, preserve_index=False)
+    con.register("events_arrow", arrow_events)
+    con.execute("CREATE TABLE events AS SELECT * FROM events_arrow;")
+
+    with open(MANIFEST_PATH, "wb") as fh:
+        fh.write(orjson.dumps({"fp": input_fp}))
 
 # 3.1 Create enriched view equivalent (we already exploded many fields in pandas)
 con.execute("""
@@ -257,6 +407,9 @@ SELECT
   quantity,
   product_id,
   referrer_domain,
+  device_type,
+  os,
+  browser,
   client_id_missing,
   source_file_referrer_missing,
   referrer_missing
@@ -332,105 +485,59 @@ WHERE client_id IS NOT NULL
 GROUP BY client_id;
 """)
 
-# 3.4 Device view
+# 3.4 Device view (device_type/os/browser are materialized in pandas above)
 con.execute("""
 CREATE OR REPLACE VIEW analytics_events_with_device AS
-SELECT
-  *,
-  /* -------------------------
-     DEVICE TYPE
-     ------------------------- */
-  CASE
-    WHEN lower(user_agent) LIKE '%ipad%' THEN 'tablet'
-    WHEN lower(user_agent) LIKE '%iphone%' THEN 'mobile'
-    WHEN lower(user_agent) LIKE '%android%' AND lower(user_agent) LIKE '%mobile%' THEN 'mobile'
-    WHEN lower(user_agent) LIKE '%android%' THEN 'tablet'
-    WHEN lower(user_agent) LIKE '%mobile%' THEN 'mobile'
-    WHEN lower(user_agent) LIKE '%windows%' OR lower(user_agent) LIKE '%macintosh%' OR lower(user_agent) LIKE '%x11%' THEN 'desktop'
-    ELSE 'unknown'
-  END AS device_type,
-
-  /* -------------------------
-     OPERATING SYSTEM
-     ------------------------- */
-  CASE
-    WHEN lower(user_agent) LIKE '%iphone%' OR lower(user_agent) LIKE '%ipad%' THEN 'iOS'
-    WHEN lower(user_agent) LIKE '%android%' THEN 'Android'
-    WHEN lower(user_agent) LIKE '%windows nt%' THEN 'Windows'
-    WHEN lower(user_agent) LIKE '%mac os x%' AND lower(user_agent) NOT LIKE '%iphone%' THEN 'MacOS'
-    WHEN lower(user_agent) LIKE '%linux%' THEN 'Linux'
-    ELSE 'Other'
-  END AS os,
-
-  /* -------------------------
-     BROWSER
-     ------------------------- */
-  CASE
-    -- Order matters here
-    WHEN lower(user_agent) LIKE '%crios%' THEN 'Chrome (iOS)'
-    WHEN lower(user_agent) LIKE '%fxios%' THEN 'Firefox (iOS)'
-    WHEN lower(user_agent) LIKE '%edgios%' THEN 'Edge (iOS)'
-    WHEN lower(user_agent) LIKE '%chrome%' AND lower(user_agent) NOT LIKE '%edg%' THEN 'Chrome'
-    WHEN lower(user_agent) LIKE '%safari%' AND lower(user_agent) NOT LIKE '%chrome%' THEN 'Safari'
-    WHEN lower(user_agent) LIKE '%firefox%' THEN 'Firefox'
-    WHEN lower(user_agent) LIKE '%edg%' THEN 'Edge'
-    ELSE 'Other'
-  END AS browser
-
-FROM analytics_events_enriched;
-
-            
-            """)
+SELECT * FROM analytics_events_enriched;
+""")
 
 # 3.5 Attribution per purchase (first & last click within 7-day window)
-# Note: DuckDB supports correlated subqueries; using them conservatively.
+# Two sorted merge-asof passes replace the window aggregation: backward
+# from the purchase timestamp for last click, forward from the start of
+# the 7-day window for first click. Each side is a single linear merge
+# over timestamp-sorted frames instead of a per-client partition sort.
+_touch_cols = ["utm_source", "utm_medium", "utm_campaign"]
+purchases = con.execute(
+    "SELECT *, COALESCE(total, 0.0) AS revenue "
+    "FROM analytics_events_enriched WHERE event_name = 'purchase'"
+).fetchdf()
+utm_ev = con.execute(
+    "SELECT client_id, timestamp_utc, utm_source, utm_medium, utm_campaign "
+    "FROM analytics_events_enriched "
+    "WHERE utm_source IS NOT NULL AND client_id IS NOT NULL"
+).fetchdf()
+
+# fetchdf can hand back different datetime resolutions per query;
+# merge_asof needs matching key dtypes.
+utm_ev["timestamp_utc"] = utm_ev["timestamp_utc"].astype(purchases["timestamp_utc"].dtype)
+
+purchases = purchases.sort_values("timestamp_utc", kind="mergesort")
+utm_ev = utm_ev.sort_values("timestamp_utc", kind="mergesort")
+
+attribution = pd.merge_asof(
+    purchases,
+    utm_ev.rename(columns={c: "last_" + c for c in _touch_cols}),
+    on="timestamp_utc", by="client_id",
+    direction="backward", tolerance=pd.Timedelta(days=7),
+)
+
+# First click: asof forward from (purchase_ts - 7 days); the tolerance
+# caps the match at the purchase timestamp itself.
+attribution["_window_start"] = (
+    attribution["timestamp_utc"] - pd.Timedelta(days=7)
+).astype(attribution["timestamp_utc"].dtype)
+attribution = pd.merge_asof(
+    attribution.sort_values("_window_start", kind="mergesort"),
+    utm_ev.rename(columns={"timestamp_utc": "_window_start",
+                           **{c: "first_" + c for c in _touch_cols}}),
+    on="_window_start", by="client_id",
+    direction="forward", tolerance=pd.Timedelta(days=7),
+).drop(columns="_window_start")
+
+con.register("purchase_attribution_df", attribution)
 con.execute("""
 CREATE OR REPLACE VIEW analytics_purchase_attribution AS
-WITH purchases AS (
-  SELECT *, COALESCE(total, 0.0) AS revenue
-  FROM analytics_events_enriched
-  WHERE event_name = 'purchase'
-)
-SELECT
-  p.*,
-  -- first touch in 7-day window (with utm)
-  (SELECT t.utm_source FROM analytics_events_enriched t
-     WHERE t.client_id = p.client_id
-       AND t.timestamp_utc BETWEEN p.timestamp_utc - INTERVAL '7 days' AND p.timestamp_utc
-       AND t.utm_source IS NOT NULL
-     ORDER BY t.timestamp_utc ASC
-     LIMIT 1) AS first_utm_source,
-  (SELECT t.utm_medium FROM analytics_events_enriched t
-     WHERE t.client_id = p.client_id
-       AND t.timestamp_utc BETWEEN p.timestamp_utc - INTERVAL '7 days' AND p.timestamp_utc
-       AND t.utm_source IS NOT NULL
-     ORDER BY t.timestamp_utc ASC
-     LIMIT 1) AS first_utm_medium,
-  (SELECT t.utm_campaign FROM analytics_events_enriched t
-     WHERE t.client_id = p.client_id
-       AND t.timestamp_utc BETWEEN p.timestamp_utc - INTERVAL '7 days' AND p.timestamp_utc
-       AND t.utm_source IS NOT NULL
-     ORDER BY t.timestamp_utc ASC
-     LIMIT 1) AS first_utm_campaign,
-  (SELECT t.utm_source FROM analytics_events_enriched t
-     WHERE t.client_id = p.client_id
-       AND t.timestamp_utc BETWEEN p.timestamp_utc - INTERVAL '7 days' AND p.timestamp_utc
-       AND t.utm_source IS NOT NULL
-     ORDER BY t.timestamp_utc DESC
-     LIMIT 1) AS last_utm_source,
-  (SELECT t.utm_medium FROM analytics_events_enriched t
-     WHERE t.client_id = p.client_id
-       AND t.timestamp_utc BETWEEN p.timestamp_utc - INTERVAL '7 days' AND p.timestamp_utc
-       AND t.utm_source IS NOT NULL
-     ORDER BY t.timestamp_utc DESC
-     LIMIT 1) AS last_utm_medium,
-  (SELECT t.utm_campaign FROM analytics_events_enriched t
-     WHERE t.client_id = p.client_id
-       AND t.timestamp_utc BETWEEN p.timestamp_utc - INTERVAL '7 days' AND p.timestamp_utc
-       AND t.utm_source IS NOT NULL
-     ORDER BY t.timestamp_utc DESC
-     LIMIT 1) AS last_utm_campaign
-FROM purchases p;
+SELECT * FROM purchase_attribution_df;
 """)
 
 # 3.6 Channel-level rollups
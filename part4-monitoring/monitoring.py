@@ -1,6 +1,8 @@
 
 # part4-monitoring/monitoring.py
 
+import os
+
 import duckdb
 import pandas as pd
 import json
@@ -9,8 +11,10 @@ from datetime import date, timedelta
 # -----------------------
 # Config
 # -----------------------
-DATA_PATH = "part2-transformation/output"
-REPORT_OUT = "part4-monitoring/monitoring_report.json"
+# Read the parquet files part3 materializes rather than rebuilding the
+# enrichment/attribution logic here.
+DATA_PATH = os.path.join("part3-analysis", "output")
+REPORT_OUT = os.path.join("part4-monitoring", "monitoring_report.json")
 
 BASELINE_DAYS = 7
 MAX_NULL_CLIENT_RATE = 0.20
@@ -24,14 +28,26 @@ MAX_REV_DROP = 0.40
 # -----------------------
 con = duckdb.connect(database=":memory:")
 
+# Use every core, cap memory, skip insertion-order bookkeeping and cache
+# parquet metadata across the reads below.
+con.execute(f"SET threads TO {os.cpu_count()};")
+con.execute("SET memory_limit = '8GB';")
+con.execute("SET preserve_insertion_order = false;")
+con.execute("SET enable_object_cache = true;")
+
+# Project only the columns the checks below touch so the parquet scan
+# skips the rest.
 con.execute(f"""
 CREATE TABLE events_enriched AS
-SELECT * FROM read_parquet('{DATA_PATH}/events_enriched.parquet');
+SELECT source_file, client_id, timestamp_utc, event_name,
+       event_data, event_data_parsed, total
+FROM read_parquet('{DATA_PATH}/events_enriched.parquet');
 """)
 
 con.execute(f"""
 CREATE TABLE purchases AS
-SELECT * FROM read_parquet('{DATA_PATH}/purchase_attribution.parquet');
+SELECT revenue, last_utm_source
+FROM read_parquet('{DATA_PATH}/purchase_attribution.parquet');
 """)
 
 data_today = con.execute("""
@@ -47,12 +63,18 @@ start_baseline = data_today - timedelta(days=BASELINE_DAYS)
 alerts = []
 
 # -----------------------
-# 1. Pipeline Health
+# 1. Pipeline Health + 2. Data Integrity (fused)
 # -----------------------
-row_count = con.execute("SELECT COUNT(*) FROM events_enriched").fetchone()[0]
-purchase_count = con.execute(
-    "SELECT COUNT(*) FROM events_enriched WHERE event_name='purchase'"
-).fetchone()[0]
+# FILTER/CASE aggregates let DuckDB compute all four metrics in one
+# vectorized scan of events_enriched instead of a round-trip per metric.
+row_count, purchase_count, null_client_rate, json_error_rate = con.execute("""
+SELECT
+  COUNT(*) AS row_count,
+  COUNT(*) FILTER (WHERE event_name = 'purchase') AS purchase_count,
+  AVG(CASE WHEN client_id IS NULL THEN 1 ELSE 0 END) AS null_client_rate,
+  AVG(CASE WHEN event_data IS NOT NULL AND event_data_parsed IS NULL THEN 1 ELSE 0 END) AS json_error_rate
+FROM events_enriched
+""").fetchone()
 
 if row_count == 0:
     alerts.append(("CRITICAL", "No events ingested today"))
@@ -60,67 +82,70 @@ if row_count == 0:
 if purchase_count == 0:
     alerts.append(("CRITICAL", "No purchases recorded today"))
 
-# -----------------------
-# 2. Data Integrity
-# -----------------------
-null_client_rate = con.execute("""
-SELECT AVG(CASE WHEN client_id IS NULL THEN 1 ELSE 0 END) FROM events_enriched
-""").fetchone()[0]
-
 if null_client_rate > MAX_NULL_CLIENT_RATE:
     alerts.append(("WARN", f"High null client_id rate: {null_client_rate:.2%}"))
 
-dup_rate = con.execute("""
-SELECT
-  COUNT(*) FILTER (WHERE cnt > 1) * 1.0 / COUNT(*)
-FROM (
-  SELECT COUNT(*) AS cnt
-  FROM events_enriched
-  GROUP BY source_file, timestamp_utc, event_name, event_data
-)
-""").fetchone()[0]
+# The two remaining scalar metrics come back as key/value rows from one
+# UNION ALL query, so a single exchange replaces two result-set setups.
+# Duplicates group on hash(event_data) - a 64-bit key instead of the
+# full JSON string - and the rate is duplicated rows over total rows.
+metrics = dict(con.execute("""
+SELECT 'dup_rate' AS k,
+  (WITH g AS (
+     SELECT COUNT(*) AS cnt
+     FROM events_enriched
+     GROUP BY source_file, timestamp_utc, event_name, hash(event_data)
+   )
+   SELECT COALESCE(SUM(cnt) FILTER (WHERE cnt > 1), 0) * 1.0 / SUM(cnt)
+   FROM g) AS v
+UNION ALL
+SELECT 'direct_share',
+  (SELECT SUM(revenue) FILTER (WHERE COALESCE(last_utm_source, 'direct') = 'direct')
+          / SUM(revenue)
+   FROM purchases)
+""").fetchall())
+
+dup_rate = metrics["dup_rate"]
+direct_share = metrics["direct_share"]
 
 if dup_rate > MAX_DUP_RATE:
     alerts.append(("WARN", f"Duplicate rate high: {dup_rate:.2%}"))
 
-json_error_rate = con.execute("""
-SELECT AVG(CASE WHEN event_data IS NOT NULL AND event_data_parsed IS NULL THEN 1 ELSE 0 END)
-FROM events_enriched
-""").fetchone()[0]
-
 if json_error_rate > MAX_JSON_ERROR_RATE:
     alerts.append(("WARN", f"JSON parse error rate high: {json_error_rate:.2%}"))
 
 # -----------------------
 # 3. Business Drift
 # -----------------------
-daily_rev = con.execute("""
+# Latest day vs the mean of the prior BASELINE_DAYS, computed in SQL so
+# only one scalar row crosses into Python instead of the whole daily frame.
+latest_rev, baseline_rev, n_days = con.execute(f"""
+WITH daily AS (
+  SELECT DATE(timestamp_utc) AS d, SUM(total) AS revenue
+  FROM events_enriched
+  WHERE event_name='purchase'
+  GROUP BY 1
+),
+ranked AS (
+  SELECT revenue,
+         row_number() OVER (ORDER BY d DESC) AS rn,
+         COUNT(*) OVER () AS n_days
+  FROM daily
+)
 SELECT
-  DATE(timestamp_utc) AS d,
-  SUM(total) AS revenue
-FROM events_enriched
-WHERE event_name='purchase'
-GROUP BY 1
-ORDER BY 1 DESC
-""").fetchdf()
-
-if len(daily_rev) > BASELINE_DAYS:
-    latest = daily_rev.iloc[0]["revenue"]
-    baseline = daily_rev.iloc[1:BASELINE_DAYS+1]["revenue"].mean()
-
-    if baseline > 0 and (baseline - latest) / baseline > MAX_REV_DROP:
+  MAX(revenue) FILTER (WHERE rn = 1) AS latest,
+  AVG(revenue) FILTER (WHERE rn BETWEEN 2 AND {BASELINE_DAYS} + 1) AS baseline,
+  MAX(n_days) AS n_days
+FROM ranked
+""").fetchone()
+
+if n_days is not None and n_days > BASELINE_DAYS:
+    if baseline_rev > 0 and (baseline_rev - latest_rev) / baseline_rev > MAX_REV_DROP:
         alerts.append((
             "CRITICAL",
-            f"Revenue drop detected: {latest:.0f} vs baseline {baseline:.0f}"
+            f"Revenue drop detected: {latest_rev:.0f} vs baseline {baseline_rev:.0f}"
         ))
 
-direct_share = con.execute("""
-SELECT
-  SUM(revenue) FILTER (WHERE COALESCE(last_utm_source,'direct')='direct')
-  / SUM(revenue)
-FROM purchases
-""").fetchone()[0]
-
 if direct_share and direct_share > MAX_DIRECT_SHARE:
     alerts.append(("WARN", f"Direct traffic unusually high: {direct_share:.2%}"))
 